@@ -1,9 +1,11 @@
-import requests
 import json
-import pandas as pd
-from dateutil import parser
+import threading
 from datetime import datetime, timedelta, timezone
 import os
+import SyncModes
+import Profiling
+import StateSnapshot
+from DefectHistory import DefectHistory, defectKey
 
 
 # Tells if the script should be run in test mode or production
@@ -32,9 +34,22 @@ motive_headers = {
 tenant = "torcrobotics.us.accelix.com" if production else "torcroboticssb.us.accelix.com"
 site = "def"
 
-def getFreightlinersAndTrailers() -> pd.DataFrame:
+# Warm start settings for the state snapshot
+assetCacheHours = 12 # Age of the cached asset index before it is fetched from fluke again
+ledgerDays = 7 # Days a posted inspection report is kept in the dedupe ledger
+
+# Posting lanes: major work orders and minor work order requests are posted by separate pools
+laneWorkers = {"major": 4, "minor": 2}
+laneLagSlo = {"major": 30 * 60, "minor": 4 * 60 * 60} # Seconds from the inspection to the fluke post
+requestTimeout = 30
+
+def getFreightlinersAndTrailers(state: dict = None, refresh: bool = False) -> "pandas.DataFrame":
     """
-    Gets all of the freightliners and trailer assets from fluke.
+    Gets all of the freightliners and trailer assets from fluke, or from the asset index of the state snapshot while it is fresh.
+
+    Args:
+        state (dict): The state snapshot, None to always fetch from fluke
+        refresh (bool): Fetch from fluke even if the asset index is fresh
 
     Returns:
         pandas.DataFrame: A DataFrame containing the following columns for each asset:
@@ -44,6 +59,16 @@ def getFreightlinersAndTrailers() -> pd.DataFrame:
 
     """
 
+    # pandas and requests are slow to import, so they are only imported when they are needed
+    import pandas as pd
+    import requests
+
+    # Uses the cached asset index if it is fresh
+    assets = state['assets'] if state is not None else {}
+    if not refresh and assets.get('records') and datetime.fromisoformat(assets['fetchedAt']) + timedelta(hours=assetCacheHours) > SyncModes.now():
+        dx = assets['records']
+        return pd.DataFrame(data={cx: [x[cx] for x in dx] for cx in sorted(dx[0].keys())})
+
     # Get the freightliner assets
     url = f'https://{tenant}/api/entities/{site}/Assets/search-paged'
 
@@ -120,6 +145,9 @@ def getFreightlinersAndTrailers() -> pd.DataFrame:
             return False
         dx.extend(response.json()['data'])
 
+    if state is not None:
+        state['assets'] = {'fetchedAt': SyncModes.now().isoformat(), 'records': dx}
+
     # dataframe
     df = pd.DataFrame(data={cx: [x[cx] for x in dx] for cx in sorted(dx[0].keys())})
 
@@ -182,17 +210,22 @@ def filterIssues(inspection_data: list) -> list:
   return important_issues
 
 
-def checkNewData(inspection_data: list) -> list:
+def checkNewData(inspection_data: list, ledger: dict = None) -> list:
     """
     Filters out the data that has already been seen and returns the new data
     
     Args:
         inspection_data (list): List of inspection reports that have been filtered for issues
+        ledger (dict): Dedupe ledger of the state snapshot, reports it has already posted are filtered out too
 
     Returns:
         list: List of inspection reports that are new since last run
     """
 
+    import pandas as pd
+    import requests
+    from dateutil import parser
+
     # Find the latest issue about the truck uploaded to fluke
     url = f'https://{tenant}/api/entities/{site}/WorkOrders/search-paged'
 
@@ -262,25 +295,33 @@ def checkNewData(inspection_data: list) -> list:
         latestFlukeUpload = lastMinorBaseTruck
 
 
+    # Inspection reports already posted by an earlier run
+    posted = ledger.get('posted', {}) if ledger is not None else {}
+
     # Checks if the new data has already been processed
     filter_data = []
     for report in inspection_data:
         motiveTime = parser.isoparse(report["date"])
         
-        if(motiveTime > latestFlukeUpload): # if motive inspection report time comes after the latest date from fluke
+        if(motiveTime > latestFlukeUpload and str(report["id"]) not in posted): # if motive inspection report time comes after the latest date from fluke
             filter_data.append(report)
 
     return filter_data
 
 
-def getMotiveData() -> list:
+def getMotiveData(ledger: dict = None) -> list:
     """
     Gets the data of inspection reports within the last day from motive API and returns the filtered data. Filtered data is ones with a issue to request a work order for and that have not already been posted to fluke. 
 
+    Args:
+        ledger (dict): Dedupe ledger of the state snapshot
+
     Returns:
         list: List of inspection reports that have been filtered for new issues that must be posted to fluke
     """
 
+    import requests
+
     # Gets all of the issues within the past 24 hours
     index = 1
     issues = []
@@ -308,7 +349,7 @@ def getMotiveData() -> list:
             break
 
         # Get current time in UTC
-        now = datetime.now(timezone.utc)
+        now = SyncModes.now()
         past_24_hours = now - timedelta(days=1)
 
         # Check if the given time is within the past 24 hours
@@ -324,7 +365,8 @@ def getMotiveData() -> list:
 
     # Makes sure the data is new compared to last uploaded fluke data
     if checkData:
-        data = checkNewData(issues)
+        with Profiling.stage("dedupe"):
+            data = checkNewData(issues, ledger)
     else: 
         data = issues
 
@@ -343,7 +385,7 @@ def convertToPost(data: list, df) -> list:
         data (list): List of inspection reports that have been filtered for new issues that must be posted to fluke
 
     Returns:
-        list: List of inspection reports that have been converted to a format that can be posted to fluke api
+        list: List of [payload, motive id, issues] for every inspection report that can be posted to fluke api
     """
 
     # Gets id of the truck or trailer
@@ -519,22 +561,36 @@ def convertToPost(data: list, df) -> list:
         post_data, motiveId = createWorkOrder(post)
 
         if(post_data != False):
-            converted_data.append([post_data, motiveId])
+            converted_data.append([post_data, motiveId, post['issues']])
 
     return converted_data
 
 
-def postWorkOrders(data: list) -> list:
+def postWorkOrders(data: list, ledger: dict = None, history: DefectHistory = None) -> list:
     """
-    Posts the work orders to fluke api and returns the responses
+    Posts the work orders to fluke api and returns the responses. Major work orders are posted first, and each
+    priority has its own lane of workers so a spike of minor requests does not delay the major ones. Reports
+    of the same defect on an asset are posted one after another in the same lane.
 
     Args:
         data (list): List of inspection reports that have been converted to a format that can be posted to fluke api
+        ledger (dict): Dedupe ledger of the state snapshot, every posted inspection report is added to it and every
+            report whose post failed is kept in its pending work orders
+        history (DefectHistory): Defect history; reports whose defects all already have an open work order on the asset are
+            linked to that work order instead of posted
 
     Returns:
         list: List of responses from the post requests
     """
 
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+    from dateutil import parser
+    from requests.adapters import HTTPAdapter
+
+    # One pooled session shared by the lanes
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=laneWorkers["major"] + laneWorkers["minor"]))
 
     def giveExternalId(inspectionReportId, inspectionReportDay, externalId):
         # Need ID and Date of the inspection report
@@ -549,43 +605,156 @@ def postWorkOrders(data: list) -> list:
             ]
         }
 
-        response = requests.put(url, json=payload, headers=motive_headers)
+        return session.put(url, json=payload, headers=motive_headers, timeout=requestTimeout)
+
+    def recordPost(work_order, flukeId, inspectionTime, linked=False):
+        if ledger is not None:
+            ledger.setdefault('posted', {})[str(work_order[1])] = SyncModes.now().isoformat()
+
+        if history is not None and len(work_order) > 2:
+            properties = work_order[0]['properties']
+            history.recordPost(properties['assetId']['id'], properties['c_compid'], work_order[1], flukeId, work_order[2], inspectionTime, linked)
 
     # Config
     woEndpoint = f"https://{tenant}/api/entities/{site}/WorkOrders"
     worEndpoint = f"https://{tenant}/api/entities/{site}/WorkOrdersRequests"
 
-    responses = []
-    # Send a post request with the data
-    for work_order in data:
+    def isMajor(work_order):
+        # Major issues go to work orders and minor issues to work order requests
+        return work_order[0]['properties']['details'][0:20] != "<b>Motive Base Truck"
+
+    def defectKeys(work_order):
+        if history is None or len(work_order) < 3:
+            return []
+
+        assetId = work_order[0]['properties']['assetId']['id']
+        return [defectKey(assetId, issue['category']) for issue in work_order[2]]
+
+    # Reports that share a defect of an asset form a chain, posted one after another so a report is only
+    # linked to a work order once that work order was posted. A failed post leaves the defects to the next report.
+    chains = []
+    chainOf = {}
+    for index, work_order in enumerate(data):
+        chain = [(index, work_order)]
+        for other in {id(chainOf[key]): chainOf[key] for key in defectKeys(work_order) if key in chainOf}.values():
+            chains.remove(other)
+            chain = other + chain
+
+        chains.append(chain)
+        for member in chain:
+            for key in defectKeys(member[1]):
+                chainOf[key] = chain
+
+    # A chain with a major report goes to the major lane, and its majors are posted first
+    lanes = {"major": [], "minor": []}
+    for chain in chains:
+        try:
+            chain = [work_order for index, work_order in sorted(chain, key=lambda member: (not isMajor(member[1]), member[0]))]
+            lanes["major" if isMajor(chain[0]) else "minor"].append(chain)
+        except:
+            for work_order in chain:
+                print("Error posting work order", flush=True)
+                print("Payload Data: " + str(work_order[1][0]), flush=True)
+                print("Motive ID: " + str(work_order[1][1]), flush=True)
 
-        endpoint = ''
+    lock = threading.Lock()
+    lags = {"major": [], "minor": []}
+    responses = []
 
-        # Check if it should go to work order requests or work order
-        
+    def post(work_order):
+        motiveId = str(work_order[1])
+        flukeId = None
         try:
-            if work_order[0]['properties']['details'][0:20] != "<b>Motive Base Truck":
+            if isMajor(work_order):
+                lane = "major"
                 endpoint = woEndpoint
-                
-                response = requests.post(endpoint, headers=headers, data=json.dumps(work_order[0]))
-                responses.append(response)
-
-                giveExternalId(work_order[1], work_order[0]['occurredOn'], response.json()['id'])
-
+                inspectionTime = work_order[0]['occurredOn']
             else:
+                lane = "minor"
                 endpoint = worEndpoint
+                inspectionTime = work_order[0]['properties']['c_requestedOn']
 
-                response = requests.post(endpoint, headers=headers, data=json.dumps(work_order[0]))
-                responses.append(response)
+            # A work order an earlier run created, but could not tag in motive, is only tagged again
+            if ledger is not None:
+                with lock:
+                    flukeId = ledger.get('pending', {}).get(motiveId, {}).get('flukeId')
 
-                giveExternalId(work_order[1], work_order[0]['properties']['c_requestedOn'], response.json()['id'])
+            # Link the report to the open work order when every defect on it is already open on the asset,
+            # so it is resolved along with that work order
+            if flukeId is None and history is not None and len(work_order) > 2 and work_order[2]:
+                with lock:
+                    flukeId = history.openWorkOrder(work_order[0]['properties']['assetId']['id'], work_order[2])
 
-        except:
-            print("Error posting work order", flush=True)
+                if flukeId is not None:
+                    print(f"Linking Motive ID {work_order[1]} to work order {flukeId}: every defect already has an open work order on {work_order[0]['properties']['c_compid']}", flush=True)
+                    with lock:
+                        recordPost(work_order, flukeId, inspectionTime, linked=True)
+
+                        # Kept until the link is resolved, in case UpdateMotive releases it
+                        if ledger is not None:
+                            ledger.setdefault('linked', {})[motiveId] = {'flukeId': flukeId, 'workOrder': work_order}
+
+            if flukeId is None:
+                response = session.post(endpoint, headers=headers, data=json.dumps(work_order[0]), timeout=requestTimeout)
+                with lock:
+                    responses.append(response)
+
+                flukeId = response.json()['id']
+
+                # Time from the inspection in motive to the work order in fluke
+                lag = (SyncModes.now() - parser.isoparse(inspectionTime)).total_seconds()
+
+                # Recorded as soon as the work order exists, so a failed tag never posts it twice
+                with lock:
+                    lags[lane].append(lag)
+                    recordPost(work_order, flukeId, inspectionTime)
+
+            response = giveExternalId(work_order[1], inspectionTime, flukeId)
+            if not response.ok:
+                raise ValueError(f"Tagging the inspection report returned {response.status_code}")
+
+            if ledger is not None:
+                with lock:
+                    ledger.get('pending', {}).pop(motiveId, None)
+
+        except Exception as err:
+            print(f"Error posting work order: {err!r}", flush=True)
             print("Payload Data: " + str(work_order[0]), flush=True)
             print("Motive ID: " + str(work_order[1]), flush=True)
+
+            # Posted (or tagged) again by the next runs, since checkNewData drops the report once a later one was posted
+            if ledger is not None:
+                with lock:
+                    pending = ledger.setdefault('pending', {})
+                    pending[motiveId] = {
+                        'since': pending.get(motiveId, {}).get('since', SyncModes.now().isoformat()),
+                        'workOrder': work_order,
+                        'flukeId': flukeId,
+                    }
+
+    def postChain(chain):
+        for work_order in chain:
+            post(work_order)
+
+    # Major work orders are dispatched first, and minor requests can never take the workers of the major lane
+    with session, ThreadPoolExecutor(laneWorkers["major"]) as majorLane, ThreadPoolExecutor(laneWorkers["minor"]) as minorLane:
+        futures = [majorLane.submit(postChain, chain) for chain in lanes["major"]]
+        futures += [minorLane.submit(postChain, chain) for chain in lanes["minor"]]
+        for future in futures:
+            future.result()
+
+    # Lag of every lane against its SLO
+    for lane in ("major", "minor"):
+        if not lags[lane]:
             continue
 
+        ordered = sorted(lags[lane])
+        slo = laneLagSlo[lane]
+        late = sum(1 for lag in ordered if lag > slo)
+        print(f"{lane.title()} lane: {len(ordered)} posted, lag p50 {ordered[len(ordered) // 2] / 60:.1f} min, max {ordered[-1] / 60:.1f} min, {late} over the {slo / 60:.0f} min SLO", flush=True)
+
+        if late:
+            print(f":warning: {late} {lane} work order(s) posted more than {slo / 60:.0f} min after the inspection", flush=True)
 
     return responses
 
@@ -595,36 +764,95 @@ def main():
     Main loop that checks for new inspection reports from motive and posts them to fluke (or saves them to a csv file during testing)
     """
 
-    # Get all of the assets
-    df = getFreightlinersAndTrailers()
+    # Record, replay or dry-run when asked for by SYNC_MODE
+    SyncModes.install()
+    Profiling.install("upload")
+
+    # Warm start from the state snapshot of the last run
+    state = StateSnapshot.load(StateSnapshot.uploadPath)
+    history = DefectHistory(state['defects'])
+
+    # Closes the defects resolved by UpdateMotive; its snapshot is only read here, never saved
+    resolveState = StateSnapshot.load(StateSnapshot.resolvePath)
+    history.applyClosures(resolveState['closed'])
+    released = history.applyResolutions(resolveState['resolved'])
+
+    # Reports linked to a work order that closed before they were made get a work order of their own
+    for motiveId in released:
+        link = state['ledger'].get('linked', {}).pop(motiveId, None)
+        if link is not None:
+            print(f"Posting Motive ID {motiveId}: work order {link['flukeId']} closed before it was reported", flush=True)
+            state['ledger'].setdefault('pending', {})[motiveId] = {'since': SyncModes.now().isoformat(), 'workOrder': link['workOrder'], 'flukeId': None}
+
+    try:
+        # Get all of the assets
+        cachedOn = state['assets'].get('fetchedAt')
+        with Profiling.stage("assets"):
+            df = getFreightlinersAndTrailers(state)
 
-    # Makes sure a dataframe is returned, and an error did not happen
-    try: 
-        if df == False:
+        # Makes sure a dataframe is returned, and an error did not happen
+        try: 
+            if df == False:
+                return
+        except:
+            pass
+
+        # Does not take much time at all; not bad to call it twice => if we only call it after then getting asset ids everytime for no reason
+        with Profiling.stage("motive"):
+            data = getMotiveData(state['ledger'])
+
+        # Only continue if Motive Data was gathered succesfully 
+        if data == False:
+            return
+
+        # only continues if there is an inspection report to upload, or a work order that failed to post earlier
+        pending = state['ledger'].get('pending', {})
+        if len(data) == 0 and not pending:
+            print("No new data.", flush=True)
             return
-    except:
-        pass
 
-    # Does not take much time at all; not bad to call it twice => if we only call it after then getting asset ids everytime for no reason
-    data = getMotiveData()
+        # converts the previous data list to a list that can be posted to fluke api
+        with Profiling.stage("convert"):
+            WO_posts = convertToPost(data, df)
 
-    # Only continue if Motive Data was gathered succesfully 
-    if data == False:
-        return
+            # A cached asset index can miss assets added to fluke since it was fetched, so it is refreshed once
+            if len(WO_posts) < len(data) and cachedOn is not None and state['assets'].get('fetchedAt') == cachedOn:
+                print("Refreshing the cached asset index", flush=True)
+                df = getFreightlinersAndTrailers(state, refresh=True)
+
+                try:
+                    if df == False:
+                        return
+                except:
+                    pass
+
+                WO_posts = convertToPost(data, df)
+
+            # The work orders that failed to post in earlier runs are posted again
+            ids = set(str(work_order[1]) for work_order in WO_posts)
+            WO_posts += [entry['workOrder'] for motiveId, entry in pending.items() if motiveId not in ids]
+
+        # posts work orders to fluke and returns the responses
+        with Profiling.stage("post"):
+            responses = postWorkOrders(WO_posts, state['ledger'], history)
 
-    # only continues if there is an inspection report to upload
-    if len(data) == 0:
-        print("No new data.", flush=True)
-        return
+        # All of the responses of uploaded work orders
+        print(":notice: Inspection Report Found", flush=True)
 
-    # converts the previous data list to a list that can be posted to fluke api
-    WO_posts = convertToPost(data, df)
+    finally:
+        # Dry runs and replays leave the snapshot alone
+        if not SyncModes.modes - {"record"}:
+            expired = (SyncModes.now() - timedelta(days=ledgerDays)).isoformat()
+            state['ledger']['posted'] = {key: value for key, value in state['ledger'].get('posted', {}).items() if value > expired}
 
-    # posts work orders to fluke and returns the responses
-    responses = postWorkOrders(WO_posts)
+            state['ledger']['linked'] = {key: value for key, value in state['ledger'].get('linked', {}).items() if history.isLinked(key, value['flukeId'])}
 
-    # All of the responses of uploaded work orders
-    print(":notice: Inspection Report Found", flush=True)
+            for motiveId, entry in list(state['ledger'].get('pending', {}).items()):
+                if entry['since'] <= expired:
+                    print(f":warning: Giving up on Motive ID {motiveId}: its work order could not be posted for {ledgerDays} days", flush=True)
+                    del state['ledger']['pending'][motiveId]
+            state['defects'] = history.toSection()
+            StateSnapshot.save(state, ['assets', 'ledger', 'defects'], StateSnapshot.uploadPath)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+import copy
+import json
+import os
+from datetime import datetime, timedelta
+
+import SyncModes
+
+
+# How often a feed ignores its watermark and sweeps the whole query to catch missed updates
+fullSweepInterval = timedelta(days=float(os.environ.get("FEED_FULL_SWEEP_DAYS", "7")))
+# Runs a failed record is retried in before it is dropped
+retryAttempts = int(os.environ.get("FEED_RETRY_ATTEMPTS", "10"))
+
+
+def _position(record, timeField):
+    from dateutil import parser
+
+    return (parser.isoparse(record[timeField]), record.get("number") or 0)
+
+
+def fetchChanges(name: str, url: str, query: dict, headers: dict, state: dict = None, timeField: str = "updatedOn") -> list:
+    """
+    Runs a fluke search-paged query as a change feed: only the records changed since the last
+    committed watermark of the feed are returned. Every fullSweepInterval (or when there is no
+    watermark yet) the whole query is swept instead. The new watermark is only kept as pending
+    until commitChanges is called after a successful run.
+
+    Args:
+        name (str): Name of the feed, the key of its watermark in the state
+        url (str): The search-paged endpoint
+        query (dict): The search body (select and filter) of the feed
+        headers (dict): Headers of the fluke requests
+        state (dict): The feed state (the watermarks of the state snapshot); None always sweeps the whole query
+        timeField (str): Field that changes whenever the record changes
+
+    Returns:
+        list: The changed records, oldest change first, then the records to retry (False if fluke returned an error)
+    """
+    import requests
+
+    if state is None:
+        state = {}
+
+    watermark = state.get("feeds", {}).get(name)
+    now = SyncModes.now()
+
+    fullSweep = watermark is None or datetime.fromisoformat(watermark["lastFullSweep"]) + fullSweepInterval <= now
+
+    data = copy.deepcopy(query)
+    names = [field["name"] for field in data["select"]]
+    for field in (timeField, "number"):
+        if field not in names:
+            data["select"].append({"name": field})
+
+    if not fullSweep:
+        data["filter"]["and"].append({"name": timeField, "op": "gte", "value": watermark[timeField]})
+
+    data["order"] = [{"name": timeField, "desc": False}, {"name": "number", "desc": False}]
+    data["page"] = 0
+
+    records = []
+    pages = 1
+    while data["page"] < pages:
+        response = requests.post(url, headers=headers, data=json.dumps(data))
+
+        if response.status_code != 200:
+            print(f"Error getting the {name} change feed", flush=True)
+            return False
+
+        response = response.json()
+        records.extend(response["data"])
+        pages = response["totalPages"]
+        data["page"] += 1
+
+    records = [(_position(record, timeField), record) for record in records if record.get(timeField)]
+
+    if not fullSweep:
+        last = (datetime.fromisoformat(watermark["position"]), watermark["number"])
+        records = [(position, record) for position, record in records if position > last]
+
+    records.sort(key=lambda item: item[0])
+
+    # New watermark, only kept once the run is committed
+    pending = dict(watermark) if watermark else {}
+    if records:
+        (position, number), record = records[-1]
+        pending.update({timeField: record[timeField], "position": position.isoformat(), "number": number})
+    if fullSweep:
+        pending["lastFullSweep"] = now.isoformat()
+
+    if pending.get(timeField):
+        state.setdefault("pending", {})[name] = pending
+
+    records = [record for position, record in records]
+
+    # Records that failed in an earlier run, unless the feed returned a newer version of them
+    ids = set(record["id"] for record in records)
+    retries = [retry["record"] for id, retry in state.get("retry", {}).get(name, {}).items() if id not in ids]
+    state.setdefault("fetched", []).append(name)
+
+    print(f"{name}: {len(records)} changed record(s){' (full sweep)' if fullSweep else ''}{f', {len(retries)} to retry' if retries else ''}", flush=True)
+
+    return records + retries
+
+
+def commitChanges(state: dict, failed: list = None):
+    """
+    Moves the pending watermarks to the committed ones, so the next run starts after them. The
+    failed records of the feeds fetched in this run are kept in the state and returned again by
+    the next fetchChanges, until they succeed or fail retryAttempts times.
+
+    Args:
+        state (dict): The feed state
+        failed (list): (feed name, record) of every record that failed in this run
+    """
+    for name, pending in state.pop("pending", {}).items():
+        state.setdefault("feeds", {})[name] = pending
+
+    retry = state.setdefault("retry", {})
+    previous = {name: retry.pop(name, {}) for name in state.pop("fetched", [])}
+
+    for name, record in failed or []:
+        if name not in previous:
+            continue
+
+        attempts = previous[name].get(record["id"], {}).get("attempts", 0) + 1
+        if attempts >= retryAttempts:
+            print(f"Error: giving up on {name} record {record['id']} after {attempts} failed run(s)", flush=True)
+            continue
+
+        retry.setdefault(name, {})[record["id"]] = {"record": record, "attempts": attempts}
@@ -0,0 +1,276 @@
+import os
+from datetime import timedelta
+
+import SyncModes
+
+
+# Days a defect is kept in the history
+historyDays = 365
+# Days an open work order is trusted to still be open when fluke never reported it closed (a
+# work order waiting on parts stays open for weeks). After this, new reports of its defects are
+# posted as a new work order.
+openDays = float(os.environ.get("DEFECT_OPEN_DAYS", "60"))
+
+
+# A defect is only linked to an open work order for a defect of the same or a higher priority
+priorityRanks = {"minor": 1, "major": 2}
+
+
+def defectKey(assetId, category) -> tuple:
+    """
+    Returns:
+        tuple: Key of a defect on an asset; categories are compared without case or surrounding spaces
+    """
+    return (assetId, str(category or "").strip().lower())
+
+
+class DefectHistory:
+    """
+    Local history of the defects synced between motive and fluke, indexed by fluke asset id,
+    defect category and status. It is fed by the posts of AutomaticWOUpload and the resolves of
+    UpdateMotive (read from the "resolved" section of its snapshot) and is kept in the "defects"
+    section of the upload snapshot.
+
+    Every record is a dict with:
+        - 'assetId': Fluke id of the truck or trailer
+        - 'asset': Number of the truck or name of the trailer (the c_compid of the work order)
+        - 'category': Category of the defect from the motive inspection
+        - 'priority': 'major' or 'minor'
+        - 'motiveId': Id of the motive inspection report
+        - 'flukeId': Id of the fluke work order or work order request
+        - 'status': 'open', 'repaired' or 'rejected'
+        - 'openedOn', 'closedOn': ISO times of the post and of the resolve
+        - 'partId': Id of the defective inspected part in motive
+        - 'reportTime': Time of the motive inspection report
+        - 'linked': True when the report was linked to an open work order instead of posted
+    """
+
+    def __init__(self, section: dict = None):
+        """
+        Args:
+            section (dict): The "defects" section of the state snapshot, None for an empty history
+        """
+        self.records = list((section or {}).get("records", []))
+
+        # (assetId, category) -> motive ids of the open defects
+        self.open = {}
+        # assetId -> category -> records
+        self.byAsset = {}
+        # motiveId -> records
+        self.byMotive = {}
+        # flukeId -> records, including the reports linked to an open work order instead of posted
+        self.byFluke = {}
+        # flukeId -> closure of the work orders fluke reported closed (see applyClosures)
+        self.closedWorkOrders = {}
+
+        for record in self.records:
+            self._index(record)
+
+    def _index(self, record):
+        key = defectKey(record["assetId"], record["category"])
+        self.byAsset.setdefault(record["assetId"], {}).setdefault(key[1], []).append(record)
+        self.byMotive.setdefault(str(record["motiveId"]), []).append(record)
+        self.byFluke.setdefault(record["flukeId"], []).append(record)
+
+        if record["status"] == "open":
+            self.open.setdefault(key, set()).add(str(record["motiveId"]))
+
+    def recordPost(self, assetId: str, asset: str, motiveId, flukeId: str, issues: list, reportTime: str = None, linked: bool = False):
+        """
+        Adds the defects of a posted inspection report (or of one linked to an open work order) as open defects
+
+        Args:
+            assetId (str): Fluke id of the asset
+            asset (str): Number of the truck or name of the trailer
+            motiveId: Id of the motive inspection report
+            flukeId (str): Id of the posted work order or work order request
+            issues (list): Issues of the inspection report (from filterIssues)
+            reportTime (str): Time of the inspection report
+            linked (bool): True when the report is linked to an open work order instead of posted
+        """
+        for issue in issues:
+            record = {
+                "assetId": assetId,
+                "asset": asset,
+                "category": issue["category"],
+                "priority": issue["priority"],
+                "motiveId": str(motiveId),
+                "flukeId": flukeId,
+                "status": "open",
+                "openedOn": SyncModes.now().isoformat(),
+                "closedOn": None,
+                "partId": issue.get("inspected_item"),
+                "reportTime": reportTime,
+                "linked": linked,
+            }
+            self.records.append(record)
+            self._index(record)
+
+    def recordResolve(self, motiveId, closedOn: str, status: str = "repaired"):
+        """
+        Closes the defects of a resolved inspection report
+
+        Args:
+            motiveId: Id of the motive inspection report
+            closedOn (str): ISO time the work order was closed
+            status (str): 'repaired' or 'rejected'
+        """
+        for record in self.byMotive.get(str(motiveId), []):
+            if record["status"] != "open":
+                continue
+
+            record["status"] = status
+            record["closedOn"] = closedOn
+
+            key = defectKey(record["assetId"], record["category"])
+            self.open[key].discard(str(motiveId))
+            if not self.open[key]:
+                del self.open[key]
+
+    def applyResolutions(self, resolved: dict) -> list:
+        """
+        Closes the defects of the inspection reports UpdateMotive resolved since the last run, and
+        unlinks the reports it released from a work order that closed before they were made
+
+        Args:
+            resolved (dict): The "resolved" section of the resolve snapshot
+
+        Returns:
+            list: Motive ids of the reports unlinked by this call, they need a work order of their own
+        """
+        released = []
+        for resolution in resolved.values():
+            if resolution["status"] == "unlinked":
+                if self.unlink(resolution["logId"], resolution["flukeId"]):
+                    released.append(str(resolution["logId"]))
+            else:
+                self.recordResolve(resolution["logId"], resolution["closedOn"], resolution["status"])
+
+        return released
+
+    def applyClosures(self, closed: dict):
+        """
+        Keeps the work orders UpdateMotive saw closed in fluke. Their defects stay open until motive
+        is resolved, but no new report is linked to them.
+
+        Args:
+            closed (dict): The "closed" section of the resolve snapshot
+        """
+        self.closedWorkOrders.update(closed)
+
+    def unlink(self, motiveId, flukeId: str) -> bool:
+        """
+        Drops the open defects of an inspection report linked to a work order
+
+        Args:
+            motiveId: Id of the motive inspection report
+            flukeId (str): Id of the work order it was linked to
+
+        Returns:
+            bool: True if the report was still linked to the work order
+        """
+        linked = [record for record in self.byMotive.get(str(motiveId), []) if record["flukeId"] == flukeId and record["status"] == "open" and record.get("linked")]
+        if not linked:
+            return False
+
+        self.records = [record for record in self.records if not any(record is other for other in linked)]
+
+        self.open, self.byAsset, self.byMotive, self.byFluke = {}, {}, {}, {}
+        for record in self.records:
+            self._index(record)
+
+        return True
+
+    def isLinked(self, motiveId, flukeId: str) -> bool:
+        """
+        Returns:
+            bool: True if the inspection report still has open defects on the work order
+        """
+        return any(record["flukeId"] == flukeId and record["status"] == "open" for record in self.byMotive.get(str(motiveId), []))
+
+    def openWorkOrder(self, assetId: str, issues: list) -> str:
+        """
+        Finds the work order that is still open for every one of the defects of an inspection report
+        on the asset, with the same or a higher priority for each defect. A major defect is only open
+        on a major work order, so a major report is never linked to a minor work order request.
+        Work orders fluke reported closed are skipped even when motive is not resolved yet, and work
+        orders opened more than openDays ago are not trusted.
+
+        Args:
+            assetId (str): Fluke id of the asset
+            issues (list): Issues of the inspection report (from filterIssues)
+
+        Returns:
+            str: Fluke id of the newest such work order, None if there is none
+        """
+        expired = (SyncModes.now() - timedelta(days=openDays)).isoformat()
+
+        flukeIds = None
+        for issue in issues:
+            rank = priorityRanks.get(issue["priority"], priorityRanks["major"])
+            records = self.byAsset.get(assetId, {}).get(defectKey(assetId, issue["category"])[1], [])
+            found = set(record["flukeId"] for record in records if record["status"] == "open" and priorityRanks.get(record["priority"], priorityRanks["major"]) >= rank)
+            flukeIds = found if flukeIds is None else flukeIds & found
+
+        # The age of a work order is the age of its first post, the reports linked to it later do not refresh it
+        openedOn = {flukeId: min(record["openedOn"] for record in self.byFluke[flukeId]) for flukeId in flukeIds or () if flukeId not in self.closedWorkOrders}
+        current = [flukeId for flukeId in openedOn if openedOn[flukeId] > expired]
+
+        if openedOn and not current:
+            print(f"Work order {max(openedOn, key=openedOn.get)} on asset {assetId} was opened more than {openDays:g} days ago (DEFECT_OPEN_DAYS); posting a new work order instead of linking", flush=True)
+
+        return max(current, key=lambda flukeId: openedOn[flukeId]) if current else None
+
+    def linkedReports(self, flukeId: str) -> list:
+        """
+        Args:
+            flukeId (str): Id of a fluke work order or work order request
+
+        Returns:
+            list: The open motive inspection reports of the work order ({'motiveId', 'reportTime', 'partIds', 'linked'})
+        """
+        reports = {}
+        for record in self.byFluke.get(flukeId, []):
+            if record["status"] != "open" or not record.get("reportTime"):
+                continue
+
+            report = reports.setdefault(record["motiveId"], {"motiveId": record["motiveId"], "reportTime": record["reportTime"], "partIds": [], "linked": record.get("linked", False)})
+            if record.get("partId") is not None:
+                report["partIds"].append(record["partId"])
+
+        return list(reports.values())
+
+    def isOpen(self, assetId: str, category: str) -> bool:
+        """
+        Returns:
+            bool: True if the asset already has an open work order for the defect category
+        """
+        return defectKey(assetId, category) in self.open
+
+    def history(self, assetId: str, category: str = None, status: str = None) -> list:
+        """
+        Args:
+            assetId (str): Fluke id of the asset
+            category (str): Only this defect category if given
+            status (str): Only defects with this status if given
+
+        Returns:
+            list: The defect records of the asset, oldest first
+        """
+        categories = self.byAsset.get(assetId, {})
+        if category is not None:
+            records = list(categories.get(defectKey(assetId, category)[1], []))
+        else:
+            records = [record for records in categories.values() for record in records]
+            records.sort(key=lambda record: record["openedOn"])
+
+        return [record for record in records if status is None or record["status"] == status]
+
+    def toSection(self) -> dict:
+        """
+        Returns:
+            dict: The "defects" section for the state snapshot, without the old defects
+        """
+        expired = (SyncModes.now() - timedelta(days=historyDays)).isoformat()
+
+        return {"records": [record for record in self.records if (record["closedOn"] or record["openedOn"]) > expired]}
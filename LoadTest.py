@@ -0,0 +1,450 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import timedelta
+from urllib.parse import parse_qs, urlparse
+
+
+# Load and soak test of the integration. Synthesized Motive inspection reports are driven through
+# AutomaticWOUpload.main (filterIssues -> convertToPost -> postWorkOrders) and UpdateMotive.main
+# against an in-process mock of the Motive and fluke APIs, while simulated mechanics close, convert
+# and reject the work orders. Nothing goes to the network.
+#
+#   python LoadTest.py --fleet 500 --reports-per-tick 100 --duration 600 --error-rate 0.01
+
+# Categories of the inspected parts of a synthesized inspection
+categories = ["Brakes", "Tires", "Lights", "Air Compressor", "Mirrors", "Horn", "Wipers", "Coupling Devices", "Fuel System", "Steering"]
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    Returns:
+        float: The value at the fraction (0 to 1) of the sorted values, 0 if there are none
+    """
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class MockApis:
+    """
+    In-process mock of the Motive and fluke APIs, installed in place of requests.Session.request.
+    Supports the endpoints the sync scripts use: fluke Assets, WorkOrders and WorkOrdersRequests
+    (search-paged and create) and Motive inspection_reports (list, external ids, lookup and
+    defect statuses).
+    """
+
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+        self.lock = threading.Lock()
+
+        self.assets = []
+        self.vehicles = []
+        self.reports = [] # newest first
+        self.reportsById = {}
+        self.externalIds = {}
+        self.workOrders = []
+        self.requests = []
+        self.number = 0
+
+        self.calls = {}
+        self.injectedErrors = 0
+        self.postedLag = []
+        self.resolvedLag = []
+
+        self._createFleet()
+
+    def _now(self):
+        import SyncModes
+
+        return SyncModes.now()
+
+    def _createFleet(self):
+        for index in range(self.args.fleet):
+            if self.rng.random() < self.args.trailer_share:
+                name = f"T{2000 + index}"
+                self.assets.append({"c_description": name, "c_assettype": "Trailer", "id": str(uuid.uuid4())})
+                self.vehicles.append({"vehicle": None, "asset": {"name": name, "make": "Trailer"}})
+            else:
+                number = f"{1000 + index}"
+                self.assets.append({"c_description": f"C{number} - Truck {index}", "c_assettype": "Freightliner", "id": str(uuid.uuid4())})
+
+                # Some trucks are named "White <model> <number>" in motive
+                label = f"White Cascadia {number}" if self.rng.random() < self.args.white_share else f"C{number}"
+                self.vehicles.append({"vehicle": {"number": label, "make": "freightliner"}, "asset": None})
+
+        # A tenant always has at least one base truck request
+        self.number += 1
+        self.requests.append(self._request({"assetId": {"subsubtitle": "Freightliner"}, "details": "", "c_requestedOn": None}, "2021-01-01T00:00:00Z"))
+
+    def _request(self, properties, createdOn):
+        return {
+            "id": str(uuid.uuid4()),
+            "number": self.number,
+            "createdOn": createdOn,
+            "updatedOn": createdOn,
+            "requestedOn": properties.get("c_requestedOn"),
+            "status": "O",
+            "details": properties.get("details"),
+            "assetId": properties.get("assetId"),
+            "isDeleted": False,
+            "site": None, "createdBy": None, "updatedBy": None, "updatedSyncDate": None, "dataSource": None,
+        }
+
+    def _workOrder(self, properties, openedOn, requestId=None):
+        return {
+            "id": str(uuid.uuid4()),
+            "number": self.number,
+            "openedOn": openedOn,
+            "updatedOn": openedOn,
+            "closedOn": None,
+            "status": "O",
+            "details": properties.get("details"),
+            "assetId": properties.get("assetId"),
+            "c_priority": properties.get("c_priority"),
+            "c_workordertype": properties.get("c_workordertype"),
+            "c_maintenancelog": None,
+            "updatedBy": {"title": "Load Test"},
+            "requestId": {"id": requestId} if requestId else None,
+            "isDeleted": False,
+        }
+
+    def generate(self, count: int):
+        """
+        Adds count new inspection reports from random vehicles of the fleet
+        """
+        # Motive times have a precision of seconds; rounding up keeps them after the last fluke post
+        now = self._now().replace(microsecond=0) + timedelta(seconds=1)
+
+        with self.lock:
+            for _ in range(count):
+                vehicle = self.rng.choice(self.vehicles)
+                parts = []
+                for category in self.rng.sample(categories, 3):
+                    if self.rng.random() < self.args.defect_rate:
+                        kind = "major" if self.rng.random() < self.args.major_share else "minor"
+                        if kind == "major" and self.rng.random() < 0.1:
+                            kind = "unknown"
+                    else:
+                        kind = "none"
+                    parts.append({"id": self.rng.randrange(10 ** 8), "type": kind, "category": category, "notes": self.rng.choice(["", "Driver noted a problem"])})
+
+                report = {
+                    "id": self.rng.randrange(10 ** 9),
+                    "time": now.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "date": now.strftime("%Y-%m-%d"),
+                    "location": "Test Yard",
+                    "vehicle": vehicle["vehicle"],
+                    "asset": vehicle["asset"],
+                    "driver": {"first_name": "load", "last_name": "test", "email": "loadtest@example.com"},
+                    "inspection_type": self.rng.choice(["pre_trip", "post_trip"]),
+                    "odometer": self.rng.randrange(10 ** 6),
+                    "status": "open",
+                    "inspected_parts": parts,
+                    "createdAt": time.perf_counter(),
+                }
+                self.reports.insert(0, report)
+                self.reportsById[str(report["id"])] = report
+
+    def work(self):
+        """
+        Simulated mechanics: closes open work orders, and converts or rejects open requests
+        """
+        now = self._now().isoformat()
+
+        with self.lock:
+            for workOrder in self.workOrders:
+                if workOrder["status"] == "O" and self.rng.random() < self.args.close_rate:
+                    workOrder.update({"status": "H", "closedOn": now, "updatedOn": now, "c_maintenancelog": "Repaired by load test"})
+
+            for request in self.requests:
+                if request["status"] != "O" or not request["details"] or self.rng.random() >= self.args.close_rate:
+                    continue
+
+                request["updatedOn"] = now
+                if self.rng.random() < self.args.reject_share:
+                    request["status"] = "X"
+                else:
+                    request["status"] = "A"
+                    self.number += 1
+                    self.workOrders.append(self._workOrder({"details": request["details"], "assetId": request["assetId"]}, now, request["id"]))
+
+    def _respond(self, status, body, url):
+        import SyncModes
+
+        return SyncModes.makeResponse(status, json.dumps(body), url)
+
+    def _search(self, records, query):
+        def matches(record):
+            for condition in query.get("filter", {}).get("and", []):
+                value = record.get(condition["name"])
+                if condition["op"] == "isfalse" and value:
+                    return False
+                if condition["op"] == "eq":
+                    if isinstance(value, dict):
+                        value = value.get("title")
+                    if str(value).lower() != str(condition["value"]).lower():
+                        return False
+                if condition["op"] == "gte" and (value is None or value < condition["value"]):
+                    return False
+            return True
+
+        found = [record for record in records if matches(record)]
+        for order in reversed(query.get("order", [])):
+            found.sort(key=lambda record: (record.get(order["name"]) is None, record.get(order["name"]) or ""), reverse=order["desc"])
+
+        size = query.get("pageSize", 50)
+        page = found[query["page"] * size:(query["page"] + 1) * size]
+        names = [field["name"] for field in query["select"]]
+
+        return {"data": [{name: record.get(name) for name in names} for record in page], "totalPages": max(1, -(-len(found) // size))}
+
+    def handle(self, session, method, url, **kwargs):
+        method = method.upper()
+        parsed = urlparse(url)
+        params = dict(parse_qs(parsed.query))
+        params.update({key: [value] for key, value in (kwargs.get("params") or {}).items()})
+        body = kwargs.get("json")
+        if body is None and kwargs.get("data"):
+            body = json.loads(kwargs["data"])
+
+        endpoint = f"{method} {re.sub(r'/[0-9a-fA-F-]*[0-9][0-9a-fA-F-]*$', '/{id}', parsed.path)}"
+
+        if self.args.latency_ms:
+            time.sleep(self.rng.expovariate(1 / self.args.latency_ms) / 1000)
+
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+            if self.rng.random() < self.args.error_rate:
+                self.injectedErrors += 1
+                return self._respond(503, {"error": "injected"}, url)
+
+            return self._route(method, parsed.path, params, body, url)
+
+    def _route(self, method, path, params, body, url):
+        now = self._now()
+
+        if path.endswith("/Assets/search-paged"):
+            return self._respond(200, self._search(self.assets, body), url)
+        if path.endswith("/WorkOrders/search-paged"):
+            return self._respond(200, self._search(self.workOrders, body), url)
+        if path.endswith("/WorkOrdersRequests/search-paged"):
+            return self._respond(200, self._search(self.requests, body), url)
+
+        if method == "POST" and path.endswith("/WorkOrders"):
+            self.number += 1
+            workOrder = self._workOrder(body["properties"], now.isoformat())
+            self.workOrders.append(workOrder)
+            return self._respond(200, {"id": workOrder["id"]}, url)
+        if method == "POST" and path.endswith("/WorkOrdersRequests"):
+            self.number += 1
+            request = self._request(body["properties"], now.isoformat())
+            self.requests.append(request)
+            return self._respond(200, {"id": request["id"]}, url)
+
+        if method == "GET" and path.endswith("/inspection_reports"):
+            size = int(params.get("per_page", ["50"])[0])
+            page = int(params.get("page_no", ["1"])[0]) - 1
+            reports = [{"inspection_report": report} for report in self.reports[page * size:(page + 1) * size]]
+            return self._respond(200, {"inspection_reports": reports}, url)
+
+        if method == "GET" and path.endswith("/lookup_by_external_id"):
+            report = self.externalIds.get(params["external_id"][0])
+            if report is None:
+                return self._respond(404, {"error": "not found"}, url)
+            return self._respond(200, {"inspection_report": {"id": report["id"], "date": report["time"], "status": report["status"], "inspected_parts": report["inspected_parts"]}}, url)
+
+        if method == "PUT" and "/inspection_reports/" in path:
+            report = self.reportsById.get(path.rsplit("/", 1)[-1])
+            if report is None:
+                return self._respond(404, {"error": "not found"}, url)
+
+            if "external_ids_attributes" in body:
+                for externalId in body["external_ids_attributes"]:
+                    self.externalIds[externalId["external_id"]] = report
+                if "postedAt" not in report:
+                    report["postedAt"] = time.perf_counter()
+                    self.postedLag.append(report["postedAt"] - report["createdAt"])
+
+            if "defect_statuses" in body and report["status"] != "resolved":
+                report["status"] = "resolved"
+                self.resolvedLag.append(time.perf_counter() - report["createdAt"])
+
+            return self._respond(200, {"inspection_report": {"id": report["id"]}}, url)
+
+        return self._respond(404, {"error": f"no mock for {method} {path}"}, url)
+
+
+def run(args) -> dict:
+    """
+    Runs the load test and returns its results
+    """
+    import requests
+    import StateSnapshot
+    import SyncModes
+    import UpdateMotive
+    import AutomaticWOUpload
+
+    rng = random.Random(args.seed)
+    mock = MockApis(args, rng)
+
+    # Every run starts from an empty state snapshot and never goes to the network
+    directory = tempfile.mkdtemp(prefix="loadtest-")
+    StateSnapshot.uploadPath = os.path.join(directory, "upload_state.json")
+    StateSnapshot.resolvePath = os.path.join(directory, "resolve_state.json")
+    SyncModes.modes.clear()
+    original = requests.Session.request
+    requests.Session.request = lambda session, method, url, **kwargs: mock.handle(session, method, url, **kwargs)
+    UpdateMotive.retryBackoff = args.retry_backoff
+
+    latencies = {"upload": [], "resolve": []}
+    failures = {"upload": 0, "resolve": 0}
+    errorLines = []
+    memory = []
+
+    tracemalloc.start()
+    baseline = None
+
+    start = time.perf_counter()
+    ticks = 0
+    while (args.iterations and ticks < args.iterations) or (not args.iterations and time.perf_counter() - start < args.duration):
+        tickStart = time.perf_counter()
+        mock.generate(args.reports_per_tick)
+
+        for name, entryPoint in (("upload", AutomaticWOUpload.main), ("resolve", UpdateMotive.main)):
+            output = io.StringIO()
+            began = time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(output):
+                    entryPoint()
+            except Exception as err:
+                failures[name] += 1
+                errorLines.append(f"{name}: {err!r}")
+            latencies[name].append(time.perf_counter() - began)
+
+            errorLines.extend(f"{name}: {line}" for line in output.getvalue().splitlines() if "Error" in line)
+
+        mock.work()
+        memory.append(tracemalloc.get_traced_memory()[0])
+        ticks += 1
+
+        # The first tick imports pandas and fills the caches, so growth is measured from after it
+        if baseline is None:
+            baseline = tracemalloc.take_snapshot()
+
+        if args.tick > 0:
+            time.sleep(max(0, args.tick - (time.perf_counter() - tickStart)))
+
+    elapsed = time.perf_counter() - start
+
+    # Memory held by the integration, without the mock's own stores
+    final = tracemalloc.take_snapshot()
+    ignored = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+    growth = sum(stat.size_diff for stat in final.filter_traces(ignored).compare_to((baseline or final).filter_traces(ignored), "filename"))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    requests.Session.request = original
+
+    defective = [report for report in mock.reports if any(part["type"] != "none" for part in report["inspected_parts"])]
+
+    return {
+        "ticks": ticks,
+        "elapsed": elapsed,
+        "reports": len(mock.reports),
+        "defectiveReports": len(defective),
+        "posted": len(mock.postedLag),
+        "resolved": len(mock.resolvedLag),
+        "notPosted": sum(1 for report in defective if "postedAt" not in report),
+        "workOrders": len(mock.workOrders),
+        "workOrderRequests": len(mock.requests) - 1,
+        "latency": {name: {"p50": percentile(values, 0.5), "p95": percentile(values, 0.95), "p99": percentile(values, 0.99), "max": max(values or [0])} for name, values in latencies.items()},
+        "timeToWorkOrder": {"p50": percentile(mock.postedLag, 0.5), "p95": percentile(mock.postedLag, 0.95), "max": max(mock.postedLag or [0])},
+        "timeToResolve": {"p50": percentile(mock.resolvedLag, 0.5), "p95": percentile(mock.resolvedLag, 0.95), "max": max(mock.resolvedLag or [0])},
+        "memory": {"first": memory[0] if memory else 0, "last": memory[-1] if memory else 0, "peak": peak, "integrationGrowth": growth},
+        "failures": failures,
+        "injectedErrors": mock.injectedErrors,
+        "errorMessages": len(errorLines),
+        "errorSample": errorLines[0:10],
+        "calls": mock.calls,
+    }
+
+
+def report(results: dict):
+    """
+    Prints the results of a load test
+    """
+    elapsed = results["elapsed"] or 1
+
+    print(f"{results['ticks']} tick(s) in {results['elapsed']:.1f}s", flush=True)
+    print(f"Reports: {results['reports']} synthesized, {results['defectiveReports']} with defects, {results['posted']} posted, {results['notPosted']} not posted (duplicates or lost), {results['resolved']} resolved", flush=True)
+    print(f"Throughput: {results['reports'] / elapsed:.1f} reports/s, {results['posted'] / elapsed:.1f} posts/s, {results['resolved'] / elapsed:.1f} resolves/s", flush=True)
+    print(f"Fluke: {results['workOrders']} work order(s), {results['workOrderRequests']} request(s)", flush=True)
+
+    for name, latency in results["latency"].items():
+        print(f"{name.title()} run: p50 {latency['p50'] * 1000:.0f} ms, p95 {latency['p95'] * 1000:.0f} ms, p99 {latency['p99'] * 1000:.0f} ms, max {latency['max'] * 1000:.0f} ms", flush=True)
+
+    for name in ("timeToWorkOrder", "timeToResolve"):
+        lag = results[name]
+        print(f"{name}: p50 {lag['p50']:.2f}s, p95 {lag['p95']:.2f}s, max {lag['max']:.2f}s", flush=True)
+
+    memory = results["memory"]
+    print(f"Memory: {memory['first'] / 1e6:.1f} MB after the first tick, {memory['last'] / 1e6:.1f} MB after the last, {memory['peak'] / 1e6:.1f} MB peak, {memory['integrationGrowth'] / 1e6:+.2f} MB held by the integration since the first tick", flush=True)
+
+    print(f"Errors: {results['injectedErrors']} injected, {results['errorMessages']} error message(s), failed runs {results['failures']}", flush=True)
+    for line in results["errorSample"]:
+        print(f"  {line}", flush=True)
+
+    for endpoint, count in sorted(results["calls"].items(), key=lambda item: -item[1]):
+        print(f"  {endpoint}: {count} call(s)", flush=True)
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Load and soak test of the Motive / fluke integration against mocked APIs")
+    parser.add_argument("--fleet", type=int, default=200, help="number of trucks and trailers")
+    parser.add_argument("--trailer-share", type=float, default=0.3, help="share of the fleet that are trailers")
+    parser.add_argument("--white-share", type=float, default=0.2, help="share of the trucks named \"White <model> <number>\" in motive")
+    parser.add_argument("--reports-per-tick", type=int, default=50, help="inspection reports synthesized every tick")
+    parser.add_argument("--defect-rate", type=float, default=0.1, help="chance that an inspected part has a defect")
+    parser.add_argument("--major-share", type=float, default=0.3, help="share of the defects that are major")
+    parser.add_argument("--close-rate", type=float, default=0.5, help="chance that mechanics close an open work order or request every tick")
+    parser.add_argument("--reject-share", type=float, default=0.2, help="share of the closed requests that are rejected")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="chance that a mocked request fails with a 503")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean latency of the mocked APIs")
+    parser.add_argument("--retry-backoff", type=float, default=0.0, help="backoff of the resolve retries in seconds")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run for")
+    parser.add_argument("--iterations", type=int, default=0, help="ticks to run for, instead of --duration")
+    parser.add_argument("--tick", type=float, default=0, help="minimum seconds between the start of two ticks")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthesized traffic")
+    parser.add_argument("--json", help="also write the results to this file")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    results = run(args)
+    report(results)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
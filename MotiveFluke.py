@@ -0,0 +1,199 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+
+# Command line entry point of the integration. Only the standard library is imported here;
+# pandas, dateutil and requests are imported by the subcommands that need them.
+#
+#   python MotiveFluke.py upload      posts new Motive inspection report issues to fluke (AutomaticWOUpload)
+#   python MotiveFluke.py resolve     resolves Motive inspection reports of closed fluke work orders (UpdateMotive)
+#   python MotiveFluke.py daemon      runs upload and resolve on an interval
+#   python MotiveFluke.py health      checks the state snapshots without going to the network
+#   python MotiveFluke.py defects     lists the defect history of the assets from the state snapshots
+#   python MotiveFluke.py bench       measures the startup time of the short commands
+
+
+def _applyModes(args):
+    # The flags are the same as the SYNC_MODE and SYNC_PROFILE environment variables
+    import SyncModes
+    import Profiling
+
+    for mode in ("record", "replay", "dry-run"):
+        if getattr(args, mode.replace("-", "_"), False):
+            SyncModes.modes.add(mode)
+
+    if args.cassette:
+        SyncModes.cassettePath = args.cassette
+
+    if args.profile:
+        Profiling.profiles.update(profile.strip() for profile in args.profile.split(",") if profile.strip())
+
+
+def upload(args):
+    _applyModes(args)
+
+    import AutomaticWOUpload
+
+    AutomaticWOUpload.main()
+    return 0
+
+
+def resolve(args):
+    _applyModes(args)
+
+    import UpdateMotive
+
+    UpdateMotive.main()
+    return 0
+
+
+def daemon(args):
+    _applyModes(args)
+
+    import AutomaticWOUpload
+    import UpdateMotive
+
+    while True:
+        start = time.monotonic()
+
+        # A failed cycle is reported and the next one still runs
+        for name, run in (("upload", AutomaticWOUpload.main), ("resolve", UpdateMotive.main)):
+            try:
+                run()
+            except Exception as err:
+                print(f"Error in the {name} cycle: {err!r}", flush=True)
+
+        if args.once:
+            return 0
+
+        time.sleep(max(0, args.interval * 60 - (time.monotonic() - start)))
+
+
+def health(args):
+    import StateSnapshot
+
+    uploadPath = args.upload_state or StateSnapshot.uploadPath
+    resolvePath = args.resolve_state or StateSnapshot.resolvePath
+    upload = StateSnapshot.load(uploadPath)
+    resolve = StateSnapshot.load(resolvePath)
+
+    print(f"Python {sys.version.split()[0]}", flush=True)
+    for path, state in ((uploadPath, upload), (resolvePath, resolve)):
+        print(f"State snapshot: {path} ({'found' if os.path.exists(path) else 'missing'}, version {state['version']})", flush=True)
+
+    fetchedAt = upload['assets'].get('fetchedAt')
+    if fetchedAt:
+        age = datetime.now(datetime.fromisoformat(fetchedAt).tzinfo) - datetime.fromisoformat(fetchedAt)
+        print(f"Asset index: {len(upload['assets'].get('records', []))} asset(s), {age.total_seconds() / 3600:.1f}h old", flush=True)
+    else:
+        print("Asset index: empty", flush=True)
+
+    print(f"Dedupe ledger: {len(upload['ledger'].get('posted', {}))} posted inspection report(s)", flush=True)
+
+    for name, watermark in sorted(resolve['watermarks'].get('feeds', {}).items()):
+        print(f"Change feed {name}: after {watermark['updatedOn']} #{watermark['number']}, last full sweep {watermark['lastFullSweep']}", flush=True)
+
+    print(f"External id cache: {len(resolve['externalIds'])} inspection report(s)", flush=True)
+    print(f"Resolved: {len(resolve['resolved'])} inspection report(s)", flush=True)
+    print(f"Closed in fluke: {len(resolve['closed'])} work order(s)", flush=True)
+
+    return 0
+
+
+def defects(args):
+    import StateSnapshot
+    from DefectHistory import DefectHistory
+
+    history = DefectHistory(StateSnapshot.load(args.upload_state or StateSnapshot.uploadPath)['defects'])
+    history.applyResolutions(StateSnapshot.load(args.resolve_state or StateSnapshot.resolvePath)['resolved'])
+
+    # Assets can be given by fluke id or by truck number / trailer name
+    assetIds = sorted(history.byAsset)
+    if args.asset:
+        assetIds = [assetId for assetId in assetIds if args.asset in (assetId, history.history(assetId)[0]['asset'])]
+
+    status = "open" if args.open else None
+    for assetId in assetIds:
+        for record in history.history(assetId, args.category, status):
+            print(f"{record['asset']:<12}{record['priority']:<7}{record['status']:<10}{record['openedOn'][0:16]:<18}{(record['closedOn'] or '')[0:16]:<18}{record['category']}", flush=True)
+
+    return 0
+
+
+def bench(args):
+    # Each command runs in a fresh interpreter, the way the workflows start it
+    commands = {
+        "python (baseline)": [sys.executable, "-c", "pass"],
+        "health": [sys.executable, __file__, "health"],
+        "help": [sys.executable, __file__, "--help"],
+        "import AutomaticWOUpload": [sys.executable, "-c", "import AutomaticWOUpload"],
+        "import UpdateMotive": [sys.executable, "-c", "import UpdateMotive"],
+        "import pandas": [sys.executable, "-c", "import pandas"],
+    }
+
+    print(f"{'Command':<28}{'Min (ms)':>10}{'Median (ms)':>13}", flush=True)
+    for name, command in commands.items():
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+            timings.append((time.perf_counter() - start) * 1000)
+
+        timings.sort()
+        print(f"{name:<28}{timings[0]:>10.1f}{timings[len(timings) // 2]:>13.1f}", flush=True)
+
+    return 0
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog="motive-fluke", description="Syncs Motive inspection reports with fluke work orders")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, run, helpText in (
+        ("upload", upload, "post new inspection report issues to fluke"),
+        ("resolve", resolve, "resolve inspection reports of closed fluke work orders"),
+        ("daemon", daemon, "run upload and resolve on an interval"),
+    ):
+        command = commands.add_parser(name, help=helpText)
+        command.set_defaults(run=run)
+        command.add_argument("--dry-run", action="store_true", help="plan the posts, tags and resolves without sending them")
+        command.add_argument("--record", action="store_true", help="record every HTTP exchange to the cassette")
+        command.add_argument("--replay", action="store_true", help="answer every HTTP request from the cassette")
+        command.add_argument("--cassette", help="path of the cassette (SYNC_CASSETTE)")
+        command.add_argument("--profile", help="profilers to run: stages, cprofile, sample (SYNC_PROFILE)")
+
+        if name == "daemon":
+            command.add_argument("--interval", type=float, default=15, help="minutes between the start of two cycles")
+            command.add_argument("--once", action="store_true", help="run a single cycle and exit")
+
+    command = commands.add_parser("health", help="check the state snapshots without going to the network")
+    command.set_defaults(run=health)
+    command.add_argument("--upload-state", help="path of the upload state snapshot (SYNC_UPLOAD_STATE)")
+    command.add_argument("--resolve-state", help="path of the resolve state snapshot (SYNC_RESOLVE_STATE)")
+
+    command = commands.add_parser("defects", help="list the defect history of the assets from the state snapshot")
+    command.set_defaults(run=defects)
+    command.add_argument("--asset", help="fluke id, truck number or trailer name of the asset")
+    command.add_argument("--category", help="only this defect category")
+    command.add_argument("--open", action="store_true", help="only the defects with an open work order")
+    command.add_argument("--upload-state", help="path of the upload state snapshot (SYNC_UPLOAD_STATE)")
+    command.add_argument("--resolve-state", help="path of the resolve state snapshot (SYNC_RESOLVE_STATE)")
+
+    command = commands.add_parser("bench", help="measure the startup time of the short commands")
+    command.set_defaults(run=bench)
+    command.add_argument("--repeat", type=int, default=5, help="runs of every command")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import atexit
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Profilers to run, comma separated (ex: "cprofile,sample"). Empty means profiling is off
+#   - stages: wall time, CPU time and HTTP wait of every pipeline stage, and time per HTTP endpoint
+#   - cprofile: deterministic profile of the main thread, written as pstats
+#   - sample: sampling profile of every thread, written as speedscope JSON
+# Any profiler also turns on the stage timings
+profiles = set(profile.strip() for profile in os.environ.get("SYNC_PROFILE", "").split(",") if profile.strip())
+outputDir = os.environ.get("SYNC_PROFILE_DIR", "profile")
+sampleInterval = float(os.environ.get("SYNC_PROFILE_INTERVAL", "0.005"))
+
+_lock = threading.Lock()
+_installed = False
+_name = "sync"
+_stages = {}
+_stageStack = []
+_endpoints = {}
+_profiler = None
+_sampler = None
+
+
+def _endpoint(method, url):
+    # Groups the urls by endpoint: query strings dropped and ids replaced (ex: GET api.gomotive.com/v2/inspection_reports/{id})
+    path = re.sub(r"^https?://", "", url.split("?")[0])
+    path = "/".join("{id}" if re.fullmatch(r"[0-9a-fA-F-]{8,}|\d+", part) else part for part in path.split("/"))
+
+    return f"{method.upper()} {path}"
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a stage of the pipeline. Stages can be nested; the time of a stage includes its inner stages.
+    HTTP requests made while the stage is running (from any thread) count as its network wait.
+
+    Args:
+        name (str): Name of the stage
+    """
+    if not profiles:
+        yield
+        return
+
+    with _lock:
+        record = _stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "http": 0.0, "requests": 0})
+        _stageStack.append(record)
+
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    try:
+        yield
+    finally:
+        with _lock:
+            record["calls"] += 1
+            record["wall"] += time.perf_counter() - wallStart
+            record["cpu"] += time.process_time() - cpuStart
+            _stageStack.remove(record)
+
+
+def _timedRequest(request):
+    def timed(session, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            return request(session, method, url, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with _lock:
+                endpoint = _endpoints.setdefault(_endpoint(method, url), {"calls": 0, "total": 0.0, "max": 0.0})
+                endpoint["calls"] += 1
+                endpoint["total"] += elapsed
+                endpoint["max"] = max(endpoint["max"], elapsed)
+
+                for record in _stageStack:
+                    record["http"] += elapsed
+                    record["requests"] += 1
+
+    return timed
+
+
+class _Sampler(threading.Thread):
+    # Samples the stacks of every other thread at a fixed interval
+    def __init__(self, interval):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.interval = interval
+        self.frames = []
+        self.frameIndex = {}
+        self.threads = {}
+        self.startTime = time.perf_counter()
+        self.stopped = threading.Event()
+
+    def frame(self, code):
+        key = (code.co_name, code.co_filename, code.co_firstlineno)
+        if key not in self.frameIndex:
+            self.frameIndex[key] = len(self.frames)
+            self.frames.append({"name": code.co_name, "file": code.co_filename, "line": code.co_firstlineno})
+        return self.frameIndex[key]
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.stopped.wait(self.interval):
+            current = time.perf_counter()
+            weight = current - last
+            last = current
+
+            for threadId, frame in sys._current_frames().items():
+                if threadId == self.ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(self.frame(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+
+                samples = self.threads.setdefault(threadId, {"samples": [], "weights": []})
+                samples["samples"].append(stack)
+                samples["weights"].append(weight)
+
+    def speedscope(self, name):
+        end = time.perf_counter() - self.startTime
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "Profiling.py",
+            "shared": {"frames": self.frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": names.get(threadId, f"thread {threadId}"),
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": end,
+                    "samples": samples["samples"],
+                    "weights": samples["weights"],
+                }
+                for threadId, samples in self.threads.items()
+            ],
+        }
+
+
+def install(name="sync"):
+    """
+    Turns on the profilers from SYNC_PROFILE. Does nothing when profiling is off, and only installs once.
+
+    Args:
+        name (str): Name of the run, used for the artifact file names
+    """
+    global _installed, _name, _profiler, _sampler
+
+    if _installed or not profiles:
+        return
+
+    unknown = profiles - {"stages", "cprofile", "sample"}
+    if unknown:
+        raise ValueError(f"Unknown SYNC_PROFILE: {', '.join(sorted(unknown))}")
+
+    import requests
+
+    _name = name
+    requests.Session.request = _timedRequest(requests.Session.request)
+
+    if "cprofile" in profiles:
+        import cProfile
+
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+    if "sample" in profiles:
+        _sampler = _Sampler(sampleInterval)
+        _sampler.start()
+
+    _installed = True
+    atexit.register(finish)
+
+
+def finish():
+    """
+    Stops the profilers and writes the artifacts of the run to SYNC_PROFILE_DIR:
+    <name>-stages.json always, <name>.pstats for cprofile and <name>.speedscope.json for sample
+    """
+    if not _installed:
+        return
+
+    os.makedirs(outputDir, exist_ok=True)
+
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(os.path.join(outputDir, f"{_name}.pstats"))
+
+    if _sampler is not None:
+        _sampler.stopped.set()
+        _sampler.join()
+        with open(os.path.join(outputDir, f"{_name}.speedscope.json"), "w") as file:
+            json.dump(_sampler.speedscope(_name), file)
+
+    with _lock:
+        with open(os.path.join(outputDir, f"{_name}-stages.json"), "w") as file:
+            json.dump({"stages": _stages, "endpoints": _endpoints}, file, indent=2)
+
+        print(f"{'Stage':<20}{'Calls':>7}{'Wall (s)':>11}{'CPU (s)':>10}{'HTTP (s)':>11}{'Requests':>10}", flush=True)
+        for stageName, record in _stages.items():
+            print(f"{stageName:<20}{record['calls']:>7}{record['wall']:>11.3f}{record['cpu']:>10.3f}{record['http']:>11.3f}{record['requests']:>10}", flush=True)
+
+        for endpoint, record in sorted(_endpoints.items(), key=lambda item: -item[1]["total"]):
+            print(f"{endpoint}: {record['calls']} call(s), {record['total']:.3f}s total, {record['max']:.3f}s max", flush=True)
+
+    print(f"Profile written to {outputDir}/", flush=True)
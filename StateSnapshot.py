@@ -0,0 +1,107 @@
+import json
+import os
+import tempfile
+
+import SyncModes
+
+
+# Bump when the layout of a section changes; snapshots of another version are ignored
+version = 1
+
+# Every workflow writes only its own snapshot, so overlapping upload and resolve runs never
+# overwrite each other. A run may read the other workflow's snapshot, but never saves it.
+uploadPath = os.environ.get("SYNC_UPLOAD_STATE", "upload_state.json")
+resolvePath = os.environ.get("SYNC_RESOLVE_STATE", "resolve_state.json")
+
+# Sections of the snapshots
+#   upload snapshot (AutomaticWOUpload):
+#   - assets: fluke asset index ({"fetchedAt": ..., "records": [...]})
+#   - ledger: inspection reports already posted to fluke or linked to an open work order ({"posted": {motiveId: postedOn}}),
+#     the work orders whose post or motive tag failed ({"pending": {motiveId: {"since", "workOrder", "flukeId"}}}),
+#     and the work orders of the reports linked to an open work order ({"linked": {motiveId: {"flukeId", "workOrder"}}})
+#   - defects: defect history of the assets (see DefectHistory)
+#   resolve snapshot (UpdateMotive):
+#   - watermarks: change feed watermarks (see ChangeFeed)
+#   - externalIds: motive inspection reports looked up by fluke id ({flukeId: {"cachedAt", "data"}}, data is None when motive has none)
+#   - resolved: inspection reports resolved in motive ({flukeId: {"logId", "closedOn", "status", "resolvedOn"}}), the
+#     linked reports under "flukeId/motiveId"; status "unlinked" releases a linked report made after the work order closed
+#   - closed: work orders and requests seen closed in fluke, resolved in motive or not ({flukeId: {"closedOn", "seenOn"}})
+sections = ("assets", "ledger", "defects", "watermarks", "externalIds", "resolved", "closed")
+
+
+def _empty() -> dict:
+    return {"version": version, **{section: {} for section in sections}}
+
+
+def _read(path: str) -> dict:
+    try:
+        with open(path) as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return _empty()
+    except ValueError:
+        print(f"Error: the state snapshot {path} is corrupt, starting cold", flush=True)
+        return _empty()
+
+    if state.get("version") != version:
+        print(f"State snapshot {path} is version {state.get('version')}, expected {version}; starting cold", flush=True)
+        return _empty()
+
+    for section in sections:
+        state.setdefault(section, {})
+
+    return state
+
+
+def load(path: str) -> dict:
+    """
+    Loads a state snapshot so a run can start warm. A recorded run keeps the snapshot it started
+    from in the cassette, and a replay starts from that copy instead of the file on disk.
+
+    Args:
+        path (str): Path of the snapshot (uploadPath or resolvePath)
+
+    Returns:
+        dict: The snapshot, with empty sections when there is no usable snapshot
+    """
+    name = os.path.basename(path)
+
+    if "replay" in SyncModes.modes:
+        state = SyncModes.recordedState(name)
+        if state is None:
+            print(f"No state snapshot {name} in {SyncModes.cassettePath}, starting cold", flush=True)
+            return _empty()
+
+        for section in sections:
+            state.setdefault(section, {})
+        return state
+
+    state = _read(path)
+
+    if "record" in SyncModes.modes:
+        SyncModes.recordState(name, state)
+
+    return state
+
+
+def save(state: dict, owned: list, path: str):
+    """
+    Atomically rewrites a state snapshot with the sections owned by this run. Only the workflow
+    that owns the snapshot saves it, so nothing else has to be kept from the file on disk.
+
+    Args:
+        state (dict): The snapshot loaded by this run
+        owned (list): The sections of the snapshot
+        path (str): Path of the snapshot (uploadPath or resolvePath)
+    """
+    current = {"version": version, **{section: state[section] for section in owned}}
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary = tempfile.mkstemp(prefix=".sync_state.", dir=directory)
+    try:
+        with os.fdopen(handle, "w") as file:
+            json.dump(current, file, separators=(",", ":"))
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
@@ -0,0 +1,213 @@
+import atexit
+import copy
+import gzip
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+
+# Run modes, comma separated (ex: "replay,dry-run"). Empty means a normal live run
+#   - record: every HTTP exchange is saved to the cassette
+#   - replay: every HTTP exchange is answered from the cassette, nothing goes to the network
+#   - dry-run: posts, tags and resolves are not sent; they are written to the plan instead
+modes = set(mode.strip() for mode in os.environ.get("SYNC_MODE", "").split(",") if mode.strip())
+cassettePath = os.environ.get("SYNC_CASSETTE", "cassette.json.gz")
+planPath = os.environ.get("SYNC_PLAN", "sync_plan.json")
+
+_lock = threading.Lock()
+_installed = False
+_originalRequest = None
+_cassette = {"recordedAt": None, "states": {}, "interactions": []}
+_replay = {}
+_plan = []
+
+
+def now() -> datetime:
+    """
+    Current time in UTC. During a replay this is the time the cassette was recorded so the
+    "past 24 hours" windows select the same reports as the recorded run.
+
+    Returns:
+        datetime: The current (or recorded) time in UTC
+    """
+    if "replay" in modes and _cassette["recordedAt"]:
+        return datetime.fromisoformat(_cassette["recordedAt"])
+
+    return datetime.now(timezone.utc)
+
+
+def recordState(name: str, state: dict):
+    """
+    Keeps a copy of a state snapshot as it was loaded at the start of a recorded run, so a replay
+    starts from the same snapshot. Only the first load of every snapshot is kept.
+
+    Args:
+        name (str): File name of the snapshot
+        state (dict): The loaded snapshot
+    """
+    with _lock:
+        _cassette["states"].setdefault(name, copy.deepcopy(state))
+
+
+def recordedState(name: str) -> dict:
+    """
+    Returns:
+        dict: A copy of the state snapshot the recorded run started from, None if it was not recorded
+    """
+    state = _cassette.get("states", {}).get(name)
+
+    return copy.deepcopy(state) if state is not None else None
+
+
+def makeResponse(status: int, body: str, url: str):
+    """
+    Builds a requests.Response without going to the network
+
+    Args:
+        status (int): HTTP status code of the response
+        body (str): Text body of the response
+        url (str): Url the response belongs to
+
+    Returns:
+        requests.Response: The response
+    """
+    import requests
+
+    response = requests.Response()
+    response.status_code = status
+    response._content = body.encode("utf-8")
+    response.encoding = "utf-8"
+    response.url = url
+    response.headers["Content-Type"] = "application/json"
+
+    return response
+
+
+def _describe(method, url, kwargs):
+    # Canonical url (with params) and body of the request; headers are never stored since they hold the keys
+    import requests
+
+    prepared = requests.Request(method.upper(), url, params=kwargs.get("params"), data=kwargs.get("data"), json=kwargs.get("json")).prepare()
+    body = prepared.body or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+
+    key = f"{prepared.method} {prepared.url} {hashlib.sha1(body).hexdigest()[0:12]}"
+
+    return (prepared.method, prepared.url, body, key)
+
+
+def _isWrite(method, url):
+    # Searches are the only posts that do not write anything
+    return method in ("PUT", "PATCH", "DELETE") or (method == "POST" and not url.split("?")[0].endswith("search-paged"))
+
+
+def _planKind(method, url, body):
+    if method == "POST":
+        return "post"
+    if b"external_ids_attributes" in body:
+        return "tag"
+    if b"defect_statuses" in body:
+        return "resolve"
+    return "write"
+
+
+def _request(session, method, url, **kwargs):
+    method, fullUrl, body, key = _describe(method, url, kwargs)
+
+    if "dry-run" in modes and _isWrite(method, fullUrl):
+        with _lock:
+            _plan.append({
+                "kind": _planKind(method, fullUrl, body),
+                "method": method,
+                "url": fullUrl,
+                "body": json.loads(body) if body else None,
+            })
+            fakeId = f"dry-run-{len(_plan)}"
+
+        return makeResponse(200, json.dumps({"id": fakeId}), fullUrl)
+
+    if "replay" in modes:
+        import requests
+
+        with _lock:
+            recorded = _replay.get(key)
+            if not recorded:
+                raise requests.ConnectionError(f"No recorded response in {cassettePath} for {key}")
+
+            # Repeated requests are answered in the recorded order, the last answer is reused after that
+            interaction = recorded.pop(0) if len(recorded) > 1 else recorded[0]
+
+        return makeResponse(interaction["status"], interaction["response"], fullUrl)
+
+    response = _originalRequest(session, method, url, **kwargs)
+
+    if "record" in modes:
+        with _lock:
+            _cassette["interactions"].append({
+                "key": key,
+                "status": response.status_code,
+                "response": response.text,
+            })
+
+    return response
+
+
+def install():
+    """
+    Turns on the modes from SYNC_MODE for every request made through the requests library.
+    Does nothing for a normal live run, and only installs once.
+    """
+    global _installed, _originalRequest
+
+    if _installed or not modes:
+        return
+
+    unknown = modes - {"record", "replay", "dry-run"}
+    if unknown:
+        raise ValueError(f"Unknown SYNC_MODE: {', '.join(sorted(unknown))}")
+    if "record" in modes and "replay" in modes:
+        raise ValueError("SYNC_MODE cannot both record and replay")
+
+    import requests
+
+    if "replay" in modes:
+        with gzip.open(cassettePath, "rt", encoding="utf-8") as file:
+            _cassette.update(json.load(file))
+
+        for interaction in _cassette["interactions"]:
+            _replay.setdefault(interaction["key"], []).append(interaction)
+    else:
+        _cassette["recordedAt"] = datetime.now(timezone.utc).isoformat()
+
+    _originalRequest = requests.Session.request
+    requests.Session.request = _request
+    _installed = True
+
+    atexit.register(finish)
+    print(f"Sync mode: {', '.join(sorted(modes))}", flush=True)
+
+
+def finish():
+    """
+    Writes the cassette (record mode) and the plan (dry-run mode) of the run
+    """
+    if "record" in modes:
+        with _lock:
+            with gzip.open(cassettePath, "wt", encoding="utf-8") as file:
+                json.dump(_cassette, file, separators=(",", ":"))
+        print(f"Recorded {len(_cassette['interactions'])} HTTP exchanges to {cassettePath}", flush=True)
+
+    if "dry-run" in modes:
+        with _lock:
+            with open(planPath, "w") as file:
+                json.dump(_plan, file, indent=2)
+
+            counts = {}
+            for step in _plan:
+                counts[step["kind"]] = counts.get(step["kind"], 0) + 1
+
+        summary = ", ".join(f"{count} {kind}(s)" for kind, count in sorted(counts.items())) or "nothing"
+        print(f"Dry run planned {summary}; written to {planPath}", flush=True)
@@ -1,5 +1,10 @@
-import requests
-import json
+from datetime import timedelta, timezone
+import SyncModes
+import ChangeFeed
+import StateSnapshot
+from DefectHistory import DefectHistory
+import Profiling
+import time
 
 production = True
 # Cookie to the sandbox
@@ -10,6 +15,17 @@ sandbox_key = "JWT-Bearer=eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJ1aWQiOiI5NWZkY
 motive_key = "9e90504a-82f0-4ed4-b54c-ce37f388f211"
 motive_sandbox = 'ab7e71b6-e38e-469b-93ac-3b50b81aa8bd'
 
+# Resolver settings for the Motive defect status updates
+resolveWorkers = 8
+resolveRetries = 3
+retryBackoff = 1
+requestTimeout = 30
+
+# Days a looked up inspection report is kept in the external id cache of the state snapshot
+externalIdCacheDays = 30
+# Days a resolved inspection report is kept in the resolve snapshot for AutomaticWOUpload
+resolvedDays = 365
+
 headers = {
     "Content-Type": "application/json", 
     "Cookie": production_key,
@@ -34,8 +50,18 @@ def filterMinorsFromMotive(inspectionReports):
 
     return filtered
 
-def findCompletedWorkOrdersAndRequests():
-    
+def findCompletedWorkOrdersAndRequests(state=None):
+    """
+    Finds the work orders and requests from motive that were closed or rejected in fluke since the last run.
+    Each search is a change feed, so only the records changed after its committed watermark are returned.
+
+    Args:
+        state (dict): The change feed watermarks, None to search all of the closed history
+
+    Returns:
+        dict: The closed major work orders, closed minor work orders and rejected work order requests
+    """
+
     # Completed Work Orders Section
     url = 'https://torcroboticssb.us.accelix.com/api/entities/def/WorkOrders/search-paged'
 
@@ -52,13 +78,8 @@ def findCompletedWorkOrdersAndRequests():
         'order': [{'name': 'number', 'desc': True}], 'pageSize': 50, 'page': 0, 'fkExpansion': True
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(data))
-
     # Checks status from major issues 
-    try:
-        MajorReportStatus = response.json()['data']
-    except:
-        MajorReportStatus = []
+    MajorReportStatus = ChangeFeed.fetchChanges("MajorWO", url, data, headers, state) or []
 
 
     # Getting completed work order requests statuses
@@ -77,9 +98,9 @@ def findCompletedWorkOrdersAndRequests():
         'order': [{'name': 'number', 'desc': True}], 'pageSize': 50, 'page': 0, 'fkExpansion': True
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = ChangeFeed.fetchChanges("MinorWO", url, data, headers, state) or []
 
-    response = filterMinorsFromMotive(response.json())
+    response = filterMinorsFromMotive({'data': response})
 
     # Checks status from major issues 
     MinorReportStatus = response
@@ -101,9 +122,9 @@ def findCompletedWorkOrdersAndRequests():
         'order': [{'name': 'number', 'desc': True}], 'pageSize': 50, 'page': 0, 'fkExpansion': True
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = ChangeFeed.fetchChanges("WOR", url, data, headers, state) or []
 
-    response = filterMinorsFromMotive(response.json())
+    response = filterMinorsFromMotive({'data': response})
     MinorWOR = response
 
     return {
@@ -113,92 +134,260 @@ def findCompletedWorkOrdersAndRequests():
     }
     
 
-def getByExternalId(externalId):
+def getByExternalId(externalId, cache=None, session=None):
+    """
+    Looks up the motive inspection report tagged with a fluke id. The inspection report of a closed work
+    order does not change, so lookups (and fluke ids motive does not know) are cached in the state snapshot.
+
+    Returns:
+        dict: The lookup, None if motive has no inspection report for the id (not worth retrying),
+            False on a server error, rate limit or connection error
+    """
+    if cache is not None and externalId in cache:
+        return cache[externalId]['data']
+
+    import requests
+
     url = "https://api.gomotive.com/v2/inspection_reports/lookup_by_external_id"
     params = {
         "external_id": externalId,
         "integration_name": "Fluke"
     }
 
-    response = requests.get(url, headers=motive_headers, params=params)
+    try:
+        if session is None:
+            response = requests.get(url, headers=motive_headers, params=params, timeout=requestTimeout)
+        else:
+            response = session.get(url, params=params, timeout=requestTimeout)
+    except requests.RequestException as err:
+        print(f"Error looking up {externalId} in motive: {err}", flush=True)
+        return False
 
-    if response.status_code != 200:
+    if response.status_code >= 500 or response.status_code == 429:
+        print(f"Error looking up {externalId} in motive: {response.status_code}", flush=True)
         return False
 
-    return response.json()
+    # Work orders that did not come from motive (legacy or created by hand) have no inspection report
+    if response.status_code == 404:
+        print("No motive inspection report for: ", externalId, flush=True)
+        if cache is not None:
+            cache[externalId] = {'cachedAt': SyncModes.now().isoformat(), 'data': None}
+        return None
 
+    if response.status_code != 200:
+        print(f"Error looking up {externalId} in motive: {response.status_code} {response.text[0:200]}", flush=True)
+        return None
+
+    data = response.json()
+
+    if cache is not None:
+        report = data['inspection_report']
+        cache[externalId] = {
+            'cachedAt': SyncModes.now().isoformat(),
+            'data': {
+                'inspection_report': {
+                    'id': report['id'],
+                    'date': report['date'],
+                    'status': report.get('status'),
+                    'inspected_parts': [{'id': part['id']} for part in report['inspected_parts']],
+                },
+            },
+        }
+
+    return data
+
+
+def markResolved(resolved, report):
+    # Keeps a resolved report, so AutomaticWOUpload closes its defects and later sweeps skip it
+    resolved[report['externalId']] = {
+        'logId': report['log_id'],
+        'closedOn': report['closedOn'],
+        'status': "rejected" if report['mechanic_note'] == 'Rejected' else "repaired",
+        'resolvedOn': SyncModes.now().isoformat(),
+    }
 
-def lookForClosedWO(currentWO):
+def parseTime(value):
+    # Fluke and motive times, as aware datetimes (times without an offset are UTC)
+    from dateutil import parser
+
+    time = parser.isoparse(value)
+    return time if time.tzinfo else time.replace(tzinfo=timezone.utc)
+
+def lookForClosedWO(currentWO, cache=None, resolved=None, failed=None, history=None, session=None, closed=None):
+    """
+    Looks up the motive inspection report of every closed work order and rejected request, along
+    with the reports AutomaticWOUpload linked to the work order instead of posting. The reports
+    that are already resolved are skipped, so a full sweep of the closed history does not resolve
+    them again. A linked report made after the work order closed was not repaired by it, so it is
+    released back to AutomaticWOUpload as "unlinked" instead of resolved.
+
+    Args:
+        currentWO (dict): The records of the change feeds (from findCompletedWorkOrdersAndRequests)
+        cache (dict): The external id cache of the state snapshot
+        resolved (dict): The resolved inspection reports by fluke id; reports motive already shows as resolved are added to it
+        failed (list): (feed name, record) of every record whose lookup failed and is worth retrying is appended to it
+        history (DefectHistory): Defect history of the upload snapshot, with the reports linked to every work order
+        session (requests.Session): Session for the lookups (from createSession), None for one connection per lookup
+        closed (dict): Every closed work order and rejected request is added to it by fluke id, whether or not motive is resolved
+
+    Returns:
+        list: The inspection reports to resolve
+    """
     motiveData = []
 
+    if resolved is None:
+        resolved = {}
+
+    def linked(externalId):
+        if history is None:
+            return []
+
+        return [report for report in history.linkedReports(externalId) if f"{externalId}/{report['motiveId']}" not in resolved]
+
+    def lookup(feed, wo, externalId):
+        # Tells AutomaticWOUpload the work order is closed, so no new report is linked to it
+        if closed is not None and externalId not in closed:
+            closed[externalId] = {'closedOn': wo.get('closedOn') or wo.get('updatedOn'), 'seenOn': SyncModes.now().isoformat()}
+
+        if externalId in resolved and not linked(externalId):
+            return False
+
+        data = getByExternalId(externalId, cache, session)
+
+        if data is None:
+            return False
+
+        if data == False and failed is not None:
+            failed.append((feed, wo))
+
+        return data
+
+    def add(data, report):
+        # The linked reports are resolved with the same mechanic sign off as the work order
+        for link in linked(report['externalId']):
+            if str(link['motiveId']) == str(report['log_id']):
+                continue
+
+            if link['linked'] and report['closedAt'] and parseTime(link['reportTime']) > parseTime(report['closedAt']):
+                print(f"Unlinking Motive ID {link['motiveId']} from work order {report['externalId']}: reported after the work order closed", flush=True)
+                resolved[f"{report['externalId']}/{link['motiveId']}"] = {
+                    'logId': link['motiveId'],
+                    'flukeId': report['externalId'],
+                    'closedOn': None,
+                    'status': "unlinked",
+                    'resolvedOn': SyncModes.now().isoformat(),
+                }
+            else:
+                motiveData.append({
+                    **report,
+                    'log_id': link['motiveId'],
+                    'date': link['reportTime'],
+                    'inspected_parts': link['partIds'],
+                    'externalId': f"{report['externalId']}/{link['motiveId']}",
+                })
+
+        if report['externalId'] in resolved:
+            return
+
+        if data['inspection_report'].get('status') == 'resolved':
+            markResolved(resolved, report)
+            return
+
+        motiveData.append(report)
+
     for wo in currentWO['WOR']:
         if(wo['status'] == "X"):
 
-            data = getByExternalId(wo['id'])
+            data = lookup("WOR", wo, wo['id'])
 
             if data == False:
-                print("NO data found for: ", wo['id'], flush=True)
                 continue
 
-            data = {
+            add(data, {
                 "log_id": data['inspection_report']['id'],
                 'date': data['inspection_report']['date'],
                 'inspected_parts': [part['id'] for part in data['inspection_report']['inspected_parts']],
                 'closedOn': data['inspection_report']['date'],
                 'mechanic_note': 'Rejected',
-                'name': 'Automatic'
-            }
-
-            motiveData.append(data)
+                'name': 'Automatic',
+                'externalId': wo['id'],
+                'closedAt': wo.get('updatedOn'),
+                'feed': "WOR",
+                'record': wo
+            })
 
     for wo in currentWO['MinorWO']:
         if(wo['status'] == "H"):
-            data = getByExternalId(wo['requestId']['id'])
+            data = lookup("MinorWO", wo, wo['requestId']['id'])
 
             if data == False:
-                print("Error: NO data found for: ", wo['requestId']['id'], flush=True)
                 continue
 
-            data = {
+            add(data, {
                 "log_id": data['inspection_report']['id'],
                 'date': data['inspection_report']['date'],
                 'inspected_parts': [part['id'] for part in data['inspection_report']['inspected_parts']],
                 'closedOn': wo['closedOn'],
                 'mechanic_note': wo['c_maintenancelog'],
-                'name': wo['updatedBy']['title']
-            }
-
-            motiveData.append(data)
+                'name': wo['updatedBy']['title'],
+                'externalId': wo['requestId']['id'],
+                'closedAt': wo.get('closedOn'),
+                'feed': "MinorWO",
+                'record': wo
+            })
 
     
     for wo in currentWO['MajorWO']:
         if(wo['status'] == "H"):
-            # Uses the request id if necessary
+            # Uses the request id if necessary; the record itself is kept as it came from the feed for retries
+            externalId = wo['id']
             try:
-                wo['id'] = wo['requestId']['id']
+                externalId = wo['requestId']['id']
             except:
                 pass
 
-            data = getByExternalId(wo['id'])
+            data = lookup("MajorWO", wo, externalId)
 
             if data == False:
-                print("Error: NO data found for: ", wo['id'], flush=True)
                 continue
 
-            data = {
+            add(data, {
                 "log_id": data['inspection_report']['id'],
                 'date': data['inspection_report']['date'],
                 'inspected_parts': [part['id'] for part in data['inspection_report']['inspected_parts']],
                 'closedOn': wo['closedOn'],
                 'mechanic_note': wo['c_maintenancelog'],
-                'name': wo['updatedBy']['title']
-            }
-
-            motiveData.append(data)
+                'name': wo['updatedBy']['title'],
+                'externalId': externalId,
+                'closedAt': wo.get('closedOn'),
+                'feed': "MajorWO",
+                'record': wo
+            })
     
     return motiveData
 
-def resolveInspectionReport(data):
+def createSession(poolSize=resolveWorkers):
+    """
+    Creates a pooled session for the Motive API so concurrent requests reuse connections
+
+    Args:
+        poolSize (int): Number of connections kept open to the Motive host
+
+    Returns:
+        requests.Session: Session with the motive headers already set
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=poolSize))
+    session.headers.update(motive_headers)
+
+    return session
+
+def resolveInspectionReport(data, session=None):
+  import requests
+
   # Need ID and Date of the inspection report
   url = f"https://api.gomotive.com/v2/inspection_reports/{data['log_id']}?time={data['date']}"
 
@@ -213,19 +402,147 @@ def resolveInspectionReport(data):
     }
   }
 
-  response = requests.put(url, json=payload, headers=motive_headers)
+  if session is None:
+    return requests.put(url, json=payload, headers=motive_headers, timeout=requestTimeout)
+
+  return session.put(url, json=payload, timeout=requestTimeout)
+
+def resolveInspectionReports(motiveData, maxWorkers=resolveWorkers, retries=resolveRetries):
+    """
+    Resolves the inspection reports concurrently over one pooled session. Motive has no batch
+    endpoint for defect statuses, so the reports are grouped by day and each PUT is retried
+    on connection errors, rate limits and server errors.
+
+    Args:
+        motiveData (list): Inspection reports returned by lookForClosedWO
+        maxWorkers (int): Maximum number of PUTs in flight at once
+        retries (int): Number of attempts made for each report
+
+    Returns:
+        list: One outcome per report (log_id, externalId, date, ok, status, attempts, error), ordered by day
+    """
+
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Group the reports by the day of the inspection
+    byDate = {}
+    for report in motiveData:
+        byDate.setdefault(str(report['date'])[0:10], []).append(report)
+
+    ordered = [report for day in sorted(byDate) for report in byDate[day]]
+
+    def resolve(report):
+        outcome = {
+            'log_id': report['log_id'],
+            'externalId': report['externalId'],
+            'date': report['date'],
+            'ok': False,
+            'status': None,
+            'attempts': 0,
+            'error': None,
+        }
+
+        for attempt in range(1, retries + 1):
+            outcome['attempts'] = attempt
+
+            try:
+                response = resolveInspectionReport(report, session)
+                outcome['status'] = response.status_code
+
+                if response.ok:
+                    outcome['ok'] = True
+                    outcome['error'] = None
+                    return outcome
+
+                outcome['error'] = response.text[0:200]
+
+                # Client errors other than rate limiting will not succeed on a retry
+                if response.status_code < 500 and response.status_code != 429:
+                    return outcome
+
+            except requests.RequestException as err:
+                outcome['error'] = str(err)
+
+            if attempt < retries:
+                time.sleep(retryBackoff * 2 ** (attempt - 1))
+
+        return outcome
+
+    session = createSession(maxWorkers)
+    with session, ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        results = list(executor.map(resolve, ordered))
+
+    # Summary of the resolves for every day
+    for day in sorted(byDate):
+        dayResults = [result for result in results if str(result['date'])[0:10] == day]
+        resolved = sum(1 for result in dayResults if result['ok'])
+        print(f"{day}: resolved {resolved}/{len(dayResults)} inspection reports", flush=True)
+
+    for result in results:
+        if not result['ok']:
+            print(f"Error resolving inspection report {result['log_id']} after {result['attempts']} attempt(s): {result['status']} {result['error']}", flush=True)
+
+    return results
+
+def main():
+    """
+    Finds the work orders and requests closed in fluke and resolves their inspection reports in motive
+    """
+
+    # Record, replay or dry-run when asked for by SYNC_MODE
+    SyncModes.install()
+    Profiling.install("resolve")
+
+    # Warm start from the state snapshot of the last run
+    state = StateSnapshot.load(StateSnapshot.resolvePath)
+
+    # The defect history of AutomaticWOUpload is only read here, never saved
+    history = DefectHistory(StateSnapshot.load(StateSnapshot.uploadPath)['defects'])
 
-if __name__ == "__main__":
     # Current Work orders and requests
-    currentWO = findCompletedWorkOrdersAndRequests()
+    with Profiling.stage("fluke"):
+        currentWO = findCompletedWorkOrdersAndRequests(state['watermarks'])
 
     # Gets the id of the motive Inspection Report
     for key in currentWO:
         if isinstance(currentWO[key], dict):
             currentWO[key] = [currentWO[key]]
 
-    motiveData = lookForClosedWO(currentWO)
+    failed = []
+    # A full sweep looks up every closed record one after another, so they share one kept alive connection
+    with Profiling.stage("lookup"), createSession(1) as session:
+        motiveData = lookForClosedWO(currentWO, state['externalIds'], state['resolved'], failed, history, session, state['closed'])
+
+    with Profiling.stage("resolve"):
+        results = resolveInspectionReports(motiveData)
+
+    # Keeps the resolved reports, AutomaticWOUpload closes their defects in the defect history
+    reports = {report['externalId']: report for report in motiveData}
+    for result in results:
+        report = reports[result['externalId']]
+        if result['ok']:
+            markResolved(state['resolved'], report)
+        elif result['status'] is None or result['status'] >= 500 or result['status'] == 429:
+            failed.append((report['feed'], report['record']))
+
+    # The watermarks always move forward; the records that failed on a server or connection error are retried by the next runs
+    ChangeFeed.commitChanges(state['watermarks'], failed)
 
-    for inspectionReport in motiveData:
-        resolveInspectionReport(inspectionReport)
+    # Ids motive does not know are kept as long as the resolved reports, so full sweeps do not look them up again
+    expired = (SyncModes.now() - timedelta(days=externalIdCacheDays)).isoformat()
+    missExpired = (SyncModes.now() - timedelta(days=resolvedDays)).isoformat()
+    state['externalIds'] = {key: value for key, value in state['externalIds'].items() if value['cachedAt'] > (expired if value['data'] is not None else missExpired)}
 
+    expired = (SyncModes.now() - timedelta(days=resolvedDays)).isoformat()
+    state['resolved'] = {key: value for key, value in state['resolved'].items() if value['resolvedOn'] > expired}
+    state['closed'] = {key: value for key, value in state['closed'].items() if value['seenOn'] > expired}
+
+    # Dry runs and replays leave the snapshot alone
+    if not SyncModes.modes - {"record"}:
+        StateSnapshot.save(state, ['watermarks', 'externalIds', 'resolved', 'closed'], StateSnapshot.resolvePath)
+
+    return results
+
+if __name__ == "__main__":
+    main()